@@ -1,11 +1,26 @@
+import asyncio
+import base64
+import hashlib
+import importlib
+import json
+import math
 import os
 import re
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime, time as time_of_day, timezone
+from functools import partial
+from operator import attrgetter, itemgetter
+from zoneinfo import ZoneInfo
+import aiohttp
 import discord
-from discord.ext import commands
+import orjson
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
-import googleapiclient.discovery
-from youtube_transcript_api import YouTubeTranscriptApi
-import openai
 
 # --- SETUP AND CONFIGURATION ---
 
@@ -15,171 +30,1071 @@ DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# Initialize the OpenAI client.
-openai.api_key = OPENAI_API_KEY
+# The OpenAI and transcript libraries are heavy to import, so we don't load
+# them at startup. They're imported the first time they're needed, in a worker
+# thread so the event loop never stalls on them. See get_openai_client and
+# fetch_transcript.
+openai_client = None
 
-# This is our simple in-memory "database".
-# It stores everything on a per-user basis using their unique Discord ID.
-# { 'user_id': { 'subject_name': {'playlist_id': '...', 'cached_lecture': {...}} } }
-user_data = {}
+# Idle YouTubeTranscriptApi clients. Each one holds an HTTP session we'd like to
+# keep reusing, but sessions aren't safe to share between threads, so every
+# fetch borrows its own client and puts it back when done. This never grows
+# past the transcript semaphore's limit.
+transcript_api_pool = []
+
+# We only ever hit one YouTube Data API endpoint, so we call it directly over
+# HTTP instead of loading the whole Google API client. The session is created
+# in AutocordBot.setup_hook, closed on shutdown, and shared so connections get reused.
+YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3"
+http_session = None
+
+# YouTube gives us 10k quota units a day (reset at midnight Pacific time), and
+# each playlist lookup costs 1. We keep a running count so we can tell people
+# to come back later instead of hammering an API that's going to say no.
+YOUTUBE_DAILY_QUOTA = 10_000
+YOUTUBE_QUOTA_RESERVE = 100
+YOUTUBE_QUOTA_TZ = ZoneInfo('America/Los_Angeles')
+youtube_quota = {'day': None, 'used': 0}
+
+# Transient YouTube errors (5xx, 429, short-term rate limits) get retried with
+# exponential back-off: 1s, 2s, 4s... capped at YOUTUBE_MAX_BACKOFF.
+YOUTUBE_MAX_ATTEMPTS = 5
+YOUTUBE_MAX_BACKOFF = 30
+YOUTUBE_RETRY_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+# A playlist lookup is one tiny GET, so give up on it well before aiohttp's
+# default 5 minutes and let the retry loop have another go.
+YOUTUBE_REQUEST_TIMEOUT = 10
+
+# Caps on how many YouTube / OpenAI calls we have in flight at once. When lots
+# of people run !latestlec together, extra calls wait their turn instead of
+# all firing at once and tripping rate limits.
+# Transcript scraping gets its own semaphore so slow fetches can't starve the
+# Data API calls, and each fetch is abandoned after TRANSCRIPT_FETCH_TIMEOUT.
+YOUTUBE_SEMAPHORE = asyncio.Semaphore(8)
+TRANSCRIPT_SEMAPHORE = asyncio.Semaphore(8)
+TRANSCRIPT_FETCH_TIMEOUT = 60
+# youtube_transcript_api errors that mean the video will never give us a transcript.
+# Matched by name so we don't have to import the library just to check.
+PERMANENT_TRANSCRIPT_ERRORS = {'TranscriptsDisabled', 'NoTranscriptFound', 'VideoUnavailable', 'InvalidVideoId', 'AgeRestricted', 'VideoUnplayable'}
+OPENAI_SEMAPHORE = asyncio.Semaphore(4)
+
+# Normal lectures go to GPT-4o in one go. Only transcripts longer than
+# SINGLE_PASS_MAX_TOKENS get summarized map-reduce style: split into chunks of
+# about SUMMARY_CHUNK_TOKENS, summarize each chunk in parallel with the cheaper
+# model, then have GPT-4o merge those notes. We estimate tokens as ~4 chars each.
+CHARS_PER_TOKEN = 4
+SINGLE_PASS_MAX_TOKENS = 100_000
+SUMMARY_CHUNK_TOKENS = 3000
+SUMMARY_CHUNK_CHARS = SUMMARY_CHUNK_TOKENS * CHARS_PER_TOKEN
+# Anything past MAX_TRANSCRIPT_TOKENS (many hours of talking) we don't summarize
+# at all, it'd just be slow and expensive.
+MAX_TRANSCRIPT_TOKENS = 200_000
+CHUNK_SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_MODEL = "gpt-4o"
+# The fixed instructions go in the system message, and the lecture itself in
+# the user message after it. Keeping these exactly the same on every call lets
+# OpenAI reuse its prompt cache for the shared prefix (cheaper and faster).
+SUMMARY_INSTRUCTIONS = "Summarize the key points of the lecture transcript you're given into clear, concise bullet points. Make it easy to digest."
+CHUNK_INSTRUCTIONS = "You'll be given one part of a longer lecture transcript. Write concise bullet-point notes on the key points it covers."
+COMBINE_INSTRUCTIONS = "You'll be given notes taken on consecutive parts of a lecture. Combine them into one summary of the key points as clear, concise bullet points. Make it easy to digest."
+# Chunk summaries are cached too, keyed by a hash of the chunk text.
+CHUNK_SUMMARY_CACHE = {}
+
+# People who opt in with !dailydigest get their latest lectures summarized once a
+# day through OpenAI's Batch API, which is half the price of regular calls but
+# can take a while. Submitted batches are checked every DIGEST_POLL_MINUTES.
+# Batches we're still waiting on live in the digest_batch_lectures table, so a
+# restart doesn't lose results we've already paid for.
+DIGEST_TIME = time_of_day(hour=7, tzinfo=timezone.utc)
+DIGEST_POLL_MINUTES = 10
+
+# Transcript fetches and summaries that are currently running, keyed by
+# ('transcript' | 'summary', video_id). A second request for the same video
+# waits on the first one's task instead of doing all the work again.
+# Anyone waiting on an in-flight summary can also register a callback here to
+# get the streamed text as it comes in, so every waiter's embed updates live.
+# { key: [on_progress, ...] }
+INFLIGHT = {}
+PROGRESS_LISTENERS = {}
+
+# Everyone's subjects live in a small SQLite database so they survive restarts.
+# One row per (user, subject): user_id, subject, playlist_id, cached_json.
+DB_PATH = os.getenv('AUTOCORD_DB_PATH', 'autocord.db')
+
+# Recently used subjects are kept in memory in front of the database.
+# It's one flat dict keyed by (Discord user ID, subject name), so a lookup is a
+# single hash and users with only a couple of subjects don't each cost a whole
+# inner dict. The least recently used subject is dropped once it holds
+# SUBJECT_CACHE_SIZE of them. The transcript in each cached_lecture is a CompressedStr.
+# { ('user_id', 'subject_name'): Subject(playlist_id='...', cached_lecture={...}) }
+SUBJECT_CACHE_SIZE = 8192
+user_data = OrderedDict()
+
+# Database writes go through this queue and are done in order by a single
+# background writer (see database_writer), so commands never wait on SQLite.
+# The writer starts in AutocordBot.setup_hook, and AutocordBot.close waits
+# for the queue to empty before shutting down.
+# Subjects that are queued but not written yet also sit in PENDING_WRITES,
+# keyed like user_data, so a read never sees an older row than what we queued.
+# { ('user_id', 'subject_name'): (user_id, subject_name, Subject(...)) }
+WRITE_QUEUE = asyncio.Queue()
+PENDING_WRITES = {}
+database_writer_task = None
+
+# Lecture caches shared by everyone, keyed by YouTube video ID.
+# If two people track the same playlist, only the first one pays for the
+# transcript fetch and the OpenAI call. Entries expire after CACHE_TTL seconds.
+# { 'video_id': {'value': ..., 'ts': 1700000000.0} }
+CACHE_TTL = 60 * 60
+CACHE_MAX_ENTRIES = 10_000
+TRANSCRIPT_CACHE = {}
+SUMMARY_CACHE = {}
+
+# How often (in seconds) to update the summary message while it's streaming in.
+STREAM_EDIT_INTERVAL = 1.5
+# Discord won't accept an embed description longer than this.
+EMBED_DESCRIPTION_LIMIT = 4096
 
 # Define the bot's permissions (intents). We need to read messages.
 intents = discord.Intents.default()
 intents.message_content = True
 
+class AutocordBot(commands.Bot):
+    """Our bot, plus the startup and shutdown steps discord.py lets us hook into."""
+
+    async def setup_hook(self):
+        """Runs once, before the bot connects to Discord."""
+        global database_writer_task, http_session
+        database_writer_task = asyncio.create_task(database_writer())
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=YOUTUBE_REQUEST_TIMEOUT))
+
+    async def close(self):
+        """Finishes any queued database writes and closes our HTTP session before shutting down."""
+        if database_writer_task is not None:
+            await WRITE_QUEUE.join()
+            database_writer_task.cancel()
+        if http_session is not None:
+            await http_session.close()
+        await super().close()
+
 # Create our discord bot instance. Commands will start with '!'.
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = AutocordBot(command_prefix='!', intents=intents)
 
 # --- HELPER FUNCTIONS ---
 
+# Compiled once up front since it runs on every !setplaylist.
+PLAYLIST_ID_RE = re.compile(r"list=([\w-]+)", re.ASCII)
+
 def extract_playlist_id(url):
     """A small helper to grab the playlist ID from a YouTube URL."""
-    match = re.search(r"list=([a-zA-Z0-9_-]+)", url)
+    match = PLAYLIST_ID_RE.search(url)
     return match.group(1) if match else None
 
+class CompressedStr:
+    """
+    A big string (like a transcript) kept zlib-compressed in memory.
+    Transcripts are very repetitive, so this shrinks them several times over.
+    Use str() to get the text back.
+    """
+    __slots__ = ('blob',)
+
+    def __init__(self, text):
+        self.blob = zlib.compress(text.encode('utf-8'))
+
+    @classmethod
+    def from_blob(cls, blob):
+        compressed = cls.__new__(cls)
+        compressed.blob = blob
+        return compressed
+
+    def __str__(self):
+        return zlib.decompress(self.blob).decode('utf-8')
+
+@dataclass(slots=True)
+class Subject:
+    """One subject a user is tracking."""
+    playlist_id: str | None = None
+    cached_lecture: dict | None = None
+
+def lecture_to_json(cached_lecture):
+    """Serializes a cached lecture for the database, keeping the transcript compressed."""
+    lecture = dict(cached_lecture)
+    lecture['transcript_z'] = base64.b64encode(lecture.pop('transcript').blob).decode('ascii')
+    return json.dumps(lecture)
+
+def lecture_from_json(cached_json):
+    """The reverse of lecture_to_json."""
+    lecture = json.loads(cached_json)
+    if 'transcript_z' in lecture:
+        lecture['transcript'] = CompressedStr.from_blob(base64.b64decode(lecture.pop('transcript_z')))
+    else:
+        # Rows saved before transcripts were compressed.
+        lecture['transcript'] = CompressedStr(lecture['transcript'])
+    return lecture
+
+def init_db():
+    """Creates our tables if this is the first run."""
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS subjects ("
+            "user_id INTEGER NOT NULL, subject TEXT NOT NULL, playlist_id TEXT, cached_json TEXT, "
+            "PRIMARY KEY (user_id, subject))"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS digest_users (user_id INTEGER PRIMARY KEY)")
+        # The last lecture each digest subject was sent, so the same one isn't sent daily.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS digest_deliveries ("
+            "user_id INTEGER NOT NULL, subject TEXT NOT NULL, video_id TEXT NOT NULL, "
+            "PRIMARY KEY (user_id, subject))"
+        )
+        # One row per lecture in a submitted digest batch. The transcript is
+        # kept compressed, and recipients is a JSON list of [user_id, subject].
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS digest_batch_lectures ("
+            "batch_id TEXT NOT NULL, video_id TEXT NOT NULL, title TEXT NOT NULL, transcript_z BLOB NOT NULL, recipients_json TEXT NOT NULL, "
+            "PRIMARY KEY (batch_id, video_id))"
+        )
+
+def subject_from_row(playlist_id, cached_json):
+    """Turns a (playlist_id, cached_json) row from the subjects table back into a Subject."""
+    return Subject(playlist_id, lecture_from_json(cached_json) if cached_json else None)
+
+def db_load_subject(user_id, subject_name):
+    """Reads one of a user's subjects out of the database, or None if they never added it."""
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        row = conn.execute(
+            "SELECT playlist_id, cached_json FROM subjects WHERE user_id = ? AND subject = ?",
+            (user_id, subject_name),
+        ).fetchone()
+    return subject_from_row(*row) if row else None
+
+def db_save_subject(user_id, subject_name, subject):
+    """Writes (or overwrites) a single subject row."""
+    cached_json = lecture_to_json(subject.cached_lecture) if subject.cached_lecture else None
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO subjects (user_id, subject, playlist_id, cached_json) VALUES (?, ?, ?, ?)",
+            (user_id, subject_name, subject.playlist_id, cached_json),
+        )
+
+def db_set_digest(user_id, enabled):
+    """Signs a user up for (or out of) the daily digest."""
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        if enabled:
+            conn.execute("INSERT OR IGNORE INTO digest_users (user_id) VALUES (?)", (user_id,))
+        else:
+            conn.execute("DELETE FROM digest_users WHERE user_id = ?", (user_id,))
+
+def db_digest_subjects():
+    """
+    Every (user_id, subject_name, playlist_id, last_video_id) with a playlist, for everyone
+    who wants the daily digest. last_video_id is the last lecture we sent them (or None).
+    """
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        return conn.execute(
+            "SELECT s.user_id, s.subject, s.playlist_id, dd.video_id FROM subjects s "
+            "JOIN digest_users d ON d.user_id = s.user_id "
+            "LEFT JOIN digest_deliveries dd ON dd.user_id = s.user_id AND dd.subject = s.subject "
+            "WHERE s.playlist_id IS NOT NULL"
+        ).fetchall()
+
+def db_digest_user_ids():
+    """The IDs of everyone who wants the daily digest."""
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        return {user_id for user_id, in conn.execute("SELECT user_id FROM digest_users")}
+
+def db_mark_digest_delivered(user_id, subject_name, video_id):
+    """Remembers which lecture we last sent for this subject so we don't send it again tomorrow."""
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO digest_deliveries (user_id, subject, video_id) VALUES (?, ?, ?)",
+            (user_id, subject_name, video_id),
+        )
+
+def db_pending_digest_videos():
+    """Video IDs that are already in a digest batch we're waiting on."""
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        return {video_id for (video_id,) in conn.execute("SELECT DISTINCT video_id FROM digest_batch_lectures")}
+
+def db_save_digest_batch(batch_id, batch_lectures):
+    """Records the lectures in a batch we just submitted, so we can deliver them even after a restart."""
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO digest_batch_lectures (batch_id, video_id, title, transcript_z, recipients_json) VALUES (?, ?, ?, ?, ?)",
+            [
+                (batch_id, video_id, lecture['title'], lecture['transcript'].blob, json.dumps(lecture['recipients']))
+                for video_id, lecture in batch_lectures.items()
+            ],
+        )
+
+def db_pending_digest_batches():
+    """IDs of every digest batch we haven't finished with yet."""
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        return [batch_id for (batch_id,) in conn.execute("SELECT DISTINCT batch_id FROM digest_batch_lectures")]
+
+def db_load_digest_batch(batch_id):
+    """The lectures in a digest batch: { 'video_id': {'title': ..., 'transcript': CompressedStr, 'recipients': [...]} }"""
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        rows = conn.execute(
+            "SELECT video_id, title, transcript_z, recipients_json FROM digest_batch_lectures WHERE batch_id = ?",
+            (batch_id,),
+        ).fetchall()
+    return {
+        video_id: {
+            'title': title,
+            'transcript': CompressedStr.from_blob(transcript_z),
+            'recipients': [tuple(recipient) for recipient in json.loads(recipients_json)],
+        }
+        for video_id, title, transcript_z, recipients_json in rows
+    }
+
+def db_delete_digest_batch(batch_id):
+    """Forgets a digest batch once it's been delivered (or has failed for good)."""
+    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
+        conn.execute("DELETE FROM digest_batch_lectures WHERE batch_id = ?", (batch_id,))
+
+def remember_subject(user_id, subject_name, subject):
+    """Puts a subject in the in-memory cache, evicting the least recently used one if it's full."""
+    user_data[(user_id, subject_name)] = subject
+    if len(user_data) > SUBJECT_CACHE_SIZE:
+        user_data.popitem(last=False)
+
+async def get_subject(user_id, subject_name):
+    """Returns the user's Subject (or None), hitting the database only if it isn't in memory."""
+    key = (user_id, subject_name)
+    subject = user_data.get(key)
+    if subject is not None:
+        user_data.move_to_end(key)
+        return subject
+
+    # If it's still waiting to be written, the database row is out of date.
+    pending = PENDING_WRITES.get(key)
+    if pending is not None:
+        subject = pending[2]
+        remember_subject(user_id, subject_name, subject)
+        return subject
+
+    subject = await asyncio.to_thread(db_load_subject, user_id, subject_name)
+    if subject is not None:
+        remember_subject(user_id, subject_name, subject)
+    return subject
+
+def save_subject(user_id, subject_name, subject):
+    """Queues a subject to be written to the database. Returns right away."""
+    write = (user_id, subject_name, subject)
+    PENDING_WRITES[(user_id, subject_name)] = write
+    WRITE_QUEUE.put_nowait(write)
+
+async def database_writer():
+    """Works through WRITE_QUEUE one write at a time, forever."""
+    while True:
+        write = await WRITE_QUEUE.get()
+        user_id, subject_name, subject = write
+        try:
+            await asyncio.to_thread(db_save_subject, user_id, subject_name, subject)
+        except Exception as e:
+            print(f"Couldn't save subject '{subject_name}' for user {user_id}: {e}")
+        finally:
+            # Only clear it if nothing newer for this subject got queued meanwhile.
+            if PENDING_WRITES.get((user_id, subject_name)) is write:
+                del PENDING_WRITES[(user_id, subject_name)]
+            WRITE_QUEUE.task_done()
+
+def cache_get(cache, video_id):
+    """Returns a cached value for the video, or None if it's missing or stale."""
+    entry = cache.get(video_id)
+    if entry is None:
+        return None
+    if time.time() - entry['ts'] > CACHE_TTL:
+        del cache[video_id]
+        return None
+    return entry['value']
+
+def cache_set(cache, video_id, value):
+    """Stores a value for the video along with the time we got it."""
+    cache.pop(video_id, None)
+    # Dicts keep insertion order, so the first key is always the oldest entry.
+    if len(cache) >= CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+    cache[video_id] = {'value': value, 'ts': time.time()}
+
+def get_cached_transcript(video_id):
+    """Transcripts are stored compressed since they're big, repetitive text."""
+    transcript = cache_get(TRANSCRIPT_CACHE, video_id)
+    return str(transcript) if transcript is not None else None
+
+def set_cached_transcript(video_id, transcript_text):
+    cache_set(TRANSCRIPT_CACHE, video_id, CompressedStr(transcript_text))
+
+def youtube_quota_left():
+    """How many YouTube quota units we think are left for today."""
+    today = datetime.now(YOUTUBE_QUOTA_TZ).date()
+    if youtube_quota['day'] != today:
+        youtube_quota['day'] = today
+        youtube_quota['used'] = 0
+    return YOUTUBE_DAILY_QUOTA - youtube_quota['used']
+
+class YouTubeAPIError(Exception):
+    """The YouTube Data API sent back an error response."""
+
+    def __init__(self, status, message, reasons):
+        super().__init__(f"YouTube API error {status}: {message}")
+        self.status = status
+        self.reasons = reasons
+
+def is_retryable_youtube_error(error):
+    """Only retry errors that might go away on their own (not bad keys, missing playlists or a used-up daily quota)."""
+    if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    if error.status >= 500 or error.status == 429:
+        return True
+    if error.status == 403:
+        return bool(error.reasons & YOUTUBE_RETRY_REASONS)
+    return False
+
+async def youtube_get(resource, params, cost=1):
+    """GETs a YouTube Data API resource, backing off and retrying on transient errors."""
+    for attempt in range(YOUTUBE_MAX_ATTEMPTS):
+        youtube_quota_left()
+        youtube_quota['used'] += cost
+        try:
+            async with YOUTUBE_SEMAPHORE:
+                async with http_session.get(f"{YOUTUBE_API_URL}/{resource}", params={**params, 'key': YOUTUBE_API_KEY}) as resp:
+                    body = await resp.read()
+                    if resp.status >= 400:
+                        # Error bodies are usually JSON, but a flaky proxy might send back HTML.
+                        try:
+                            error = orjson.loads(body).get('error', {})
+                        except (orjson.JSONDecodeError, AttributeError):
+                            error = {}
+                        reasons = {detail.get('reason') for detail in error.get('errors', [])}
+                        raise YouTubeAPIError(resp.status, error.get('message', resp.reason), reasons)
+                    return orjson.loads(body)
+        except (YouTubeAPIError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == YOUTUBE_MAX_ATTEMPTS - 1 or not is_retryable_youtube_error(e):
+                raise
+            delay = min(2 ** attempt, YOUTUBE_MAX_BACKOFF)
+            print(f"YouTube API request failed ({type(e).__name__}: {e}), retrying in {delay}s (attempt {attempt + 1}/{YOUTUBE_MAX_ATTEMPTS})")
+            await asyncio.sleep(delay)
+
+async def get_latest_video(playlist_id):
+    """Returns the snippet of the newest video in the playlist, or None if it's empty."""
+    # We only need the title and video ID, so ask YouTube to leave out the rest
+    # of the snippet (thumbnails, description...) and keep the response tiny.
+    response = await youtube_get('playlistItems', {
+        'part': 'snippet',
+        'playlistId': playlist_id,
+        'maxResults': 1,
+        'fields': 'items(snippet(title,resourceId/videoId))',
+    })
+    items = response.get('items')
+    return items[0]['snippet'] if items else None
+
+def run_once(key, make_coro, on_progress=None):
+    """
+    Runs make_coro() as a task, unless a task for the same key is already in flight,
+    in which case we piggyback on that one. Returns an awaitable for the result.
+    If on_progress is given, it gets every update the task sends to report_progress(key, ...).
+    """
+    if on_progress is not None:
+        PROGRESS_LISTENERS.setdefault(key, []).append(on_progress)
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(make_coro())
+        INFLIGHT[key] = task
+
+        def forget(_):
+            INFLIGHT.pop(key, None)
+            PROGRESS_LISTENERS.pop(key, None)
+
+        task.add_done_callback(forget)
+    # Shielded so one impatient caller getting cancelled doesn't cancel it for everyone.
+    return asyncio.shield(task)
+
+async def report_progress(key, partial_result):
+    """Passes a progress update on to everyone waiting on the task for this key, all at once."""
+    listeners = list(PROGRESS_LISTENERS.get(key, []))
+    await asyncio.gather(*[on_progress(partial_result) for on_progress in listeners], return_exceptions=True)
+
+async def get_openai_client():
+    """Imports openai and builds the client the first time it's needed. We use the async one so a slow summary doesn't freeze the bot."""
+    global openai_client
+    if openai_client is None:
+        openai = await asyncio.to_thread(importlib.import_module, 'openai')
+        # Someone else may have built it while we were importing.
+        if openai_client is None:
+            openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return openai_client
+
+def is_permanent_transcript_error(error):
+    """True if retrying the transcript fetch tomorrow won't help."""
+    return type(error).__name__ in PERMANENT_TRANSCRIPT_ERRORS
+
+async def fetch_transcript(video_id):
+    """Grabs the video's transcript as one big string, from the cache if we can."""
+    transcript_text = get_cached_transcript(video_id)
+    if transcript_text is not None:
+        return transcript_text
+
+    # Only slow the first time; after that it's already in sys.modules.
+    youtube_transcript_api = await asyncio.to_thread(importlib.import_module, 'youtube_transcript_api')
+    async with TRANSCRIPT_SEMAPHORE:
+        # Reuse an idle client (and its open connections) if there is one.
+        ytt_api = transcript_api_pool.pop() if transcript_api_pool else youtube_transcript_api.YouTubeTranscriptApi()
+        timed_out = False
+        try:
+            transcript_data = await asyncio.wait_for(asyncio.to_thread(ytt_api.fetch, video_id), TRANSCRIPT_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            # After a timeout the worker thread may still be using this client, so don't hand it out again.
+            if not timed_out:
+                transcript_api_pool.append(ytt_api)
+    
+    if hasattr(transcript_data, 'transcript'):
+        transcript_list = transcript_data.transcript
+    elif hasattr(transcript_data, 'captions'):
+        transcript_list = transcript_data.captions
+    else:
+        transcript_list = list(transcript_data)
+    
+    # Every snippet has the same shape, so check the first one and use that getter for all.
+    if transcript_list:
+        get_text = itemgetter('text') if isinstance(transcript_list[0], dict) else attrgetter('text')
+        transcript_text = " ".join(map(get_text, transcript_list))
+    else:
+        transcript_text = ""
+    set_cached_transcript(video_id, transcript_text)
+    return transcript_text
+
+def estimate_tokens(text):
+    """A rough token count. Way cheaper than actually tokenizing and close enough for limits."""
+    return len(text) // CHARS_PER_TOKEN
+
+def split_transcript(transcript_text, max_chars=SUMMARY_CHUNK_CHARS):
+    """Cuts the transcript into pieces of at most max_chars, breaking on spaces where possible."""
+    chunks = []
+    start = 0
+    while len(transcript_text) - start > max_chars:
+        cut = transcript_text.rfind(' ', start, start + max_chars)
+        if cut <= start:
+            cut = start + max_chars
+        chunks.append(transcript_text[start:cut])
+        start = cut + 1 if transcript_text[cut:cut + 1] == ' ' else cut
+    if start < len(transcript_text):
+        chunks.append(transcript_text[start:])
+    return chunks
+
+def build_summary_messages(video_title, transcript_text):
+    """The chat messages for summarizing a whole transcript in one go."""
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Lecture Title: {video_title}\n\nTranscript:\n{transcript_text}"},
+    ]
+
+async def summarize_chunk(video_title, chunk_text, part, total_parts):
+    """Boils one piece of a long transcript down to notes (the 'map' step)."""
+    chunk_key = hashlib.sha256(chunk_text.encode('utf-8')).hexdigest()
+    notes = cache_get(CHUNK_SUMMARY_CACHE, chunk_key)
+    if notes is not None:
+        return notes
+
+    messages = [
+        {"role": "system", "content": CHUNK_INSTRUCTIONS},
+        {"role": "user", "content": f"Lecture Title: {video_title}\nPart {part} of {total_parts}\n\nTranscript:\n{chunk_text}"},
+    ]
+    aclient = await get_openai_client()
+    async with OPENAI_SEMAPHORE:
+        chat_completion = await aclient.chat.completions.create(
+            messages=messages,
+            model=CHUNK_SUMMARY_MODEL,
+        )
+    notes = chat_completion.choices[0].message.content
+    cache_set(CHUNK_SUMMARY_CACHE, chunk_key, notes)
+    return notes
+
+async def summarize_transcript(video_id, video_title, transcript_text, on_progress):
+    """Streams a GPT-4o summary of the transcript, handing the text so far to on_progress every so often."""
+    if estimate_tokens(transcript_text) <= SINGLE_PASS_MAX_TOKENS:
+        messages = build_summary_messages(video_title, transcript_text)
+    else:
+        # Too long to send in one go, so summarize the chunks in parallel first.
+        chunks = split_transcript(transcript_text)
+        chunk_notes = await asyncio.gather(*[
+            summarize_chunk(video_title, chunk, part, len(chunks))
+            for part, chunk in enumerate(chunks, start=1)
+        ])
+        notes_text = "\n\n".join(f"Part {part}:\n{notes}" for part, notes in enumerate(chunk_notes, start=1))
+        messages = [
+            {"role": "system", "content": COMBINE_INSTRUCTIONS},
+            {"role": "user", "content": f"Lecture Title: {video_title}\n\nNotes:\n{notes_text}"},
+        ]
+    
+    aclient = await get_openai_client()
+    async with OPENAI_SEMAPHORE:
+        stream = await aclient.chat.completions.create(
+            messages=messages,
+            model=SUMMARY_MODEL,
+            stream=True,
+        )
+
+        summary = ""
+        last_edit = time.monotonic()
+        progress_task = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            summary += chunk.choices[0].delta.content or ""
+            # Don't edit too often, Discord only allows ~5 edits per 5 seconds.
+            # The edits run in the background so we keep reading the stream meanwhile.
+            # If the last one is still going we skip this one; the next will have the newer text anyway.
+            if summary and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and (progress_task is None or progress_task.done()):
+                progress_task = asyncio.create_task(on_progress(summary))
+                last_edit = time.monotonic()
+
+    # Let the last progress edit land so it can't overwrite the finished summary.
+    if progress_task is not None:
+        await progress_task
+
+    cache_set(SUMMARY_CACHE, video_id, summary)
+    return summary
+
+def build_summary_embed(video_title, video_url, subject_name, summary):
+    """Builds the embed we show for a lecture summary (finished or still streaming)."""
+    embed = discord.Embed(
+        title=f"📝 Here's the TL;DW for: {video_title}",
+        description=summary[:EMBED_DESCRIPTION_LIMIT],
+        color=discord.Color.from_rgb(114, 137, 218) # Blurple color
+    )
+    embed.add_field(name="Watch the Full Lecture", value=f"[Click here to watch]({video_url})", inline=False)
+    embed.set_footer(text=f"Now you can run !quizme {subject_name} for a quick quiz on this.")
+    return embed
+
+# --- DAILY DIGEST ---
+
+async def collect_digest_lectures():
+    """Finds each digest subscriber's latest lectures that we haven't sent them yet, grouped by video."""
+    lectures = {}
+    # { ('user_id', 'subject_name'): ('playlist_id', 'last_video_id') }
+    subscriptions = {
+        (user_id, subject_name): (playlist_id, last_video_id)
+        for user_id, subject_name, playlist_id, last_video_id in await asyncio.to_thread(db_digest_subjects)
+    }
+    # Recent !addsubject / !setplaylist changes may not be in the database yet, so lay them on top.
+    if PENDING_WRITES:
+        digest_user_ids = await asyncio.to_thread(db_digest_user_ids)
+        for (user_id, subject_name), (_, _, subject) in list(PENDING_WRITES.items()):
+            if user_id not in digest_user_ids:
+                continue
+            if subject.playlist_id is None:
+                subscriptions.pop((user_id, subject_name), None)
+                continue
+            _, last_video_id = subscriptions.get((user_id, subject_name), (None, None))
+            subscriptions[(user_id, subject_name)] = (subject.playlist_id, last_video_id)
+
+    # Lots of people follow the same course playlist, so look each one up only once.
+    # { 'playlist_id': [(user_id, subject_name, last_video_id), ...] }
+    playlists = {}
+    for (user_id, subject_name), (playlist_id, last_video_id) in subscriptions.items():
+        playlists.setdefault(playlist_id, []).append((user_id, subject_name, last_video_id))
+    # Lectures already in a batch we're waiting on will be delivered when it finishes.
+    pending_videos = await asyncio.to_thread(db_pending_digest_videos)
+
+    for playlist_id, subscribers in playlists.items():
+        if youtube_quota_left() <= YOUTUBE_QUOTA_RESERVE:
+            print("Daily digest: out of YouTube quota, skipping the rest for today.")
+            return lectures
+        try:
+            latest_video = await get_latest_video(playlist_id)
+        except Exception as e:
+            print(f"Daily digest: couldn't check playlist {playlist_id}: {e}")
+            continue
+        if latest_video is None:
+            continue
+        video_id = latest_video['resourceId']['videoId']
+        if video_id in pending_videos:
+            continue
+        recipients = [(user_id, subject_name) for user_id, subject_name, last_video_id in subscribers if last_video_id != video_id]
+        if not recipients:
+            continue
+        lecture = lectures.setdefault(video_id, {'title': latest_video['title'], 'recipients': []})
+        lecture['recipients'].extend(recipients)
+    return lectures
+
+async def deliver_digest(video_id, lecture, summary):
+    """DMs a finished summary to everyone waiting on it and caches it on their subject."""
+    video_url = f"https://www.youtube.com/watch?v={video_id}"
+    for user_id, subject_name in lecture['recipients']:
+        subject = await get_subject(user_id, subject_name)
+        if subject is not None:
+            subject.cached_lecture = {
+                'transcript': lecture['transcript'],
+                'summary': summary,
+                'title': lecture['title']
+            }
+            save_subject(user_id, subject_name, subject)
+        try:
+            user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+            await user.send("📬 Your daily lecture digest is here!", embed=build_summary_embed(lecture['title'], video_url, subject_name, summary))
+        except discord.HTTPException as e:
+            print(f"Daily digest: couldn't DM user {user_id}: {e}")
+        # Marked even if the DM failed, otherwise someone with DMs closed would
+        # cost us a fresh summary every single day.
+        await asyncio.to_thread(db_mark_digest_delivered, user_id, subject_name, video_id)
+
+async def skip_digest(video_id, lecture):
+    """Marks a lecture we'll never be able to summarize as handled, so we stop retrying it every day."""
+    for user_id, subject_name in lecture['recipients']:
+        await asyncio.to_thread(db_mark_digest_delivered, user_id, subject_name, video_id)
+
+async def prepare_digest_lecture(video_id, lecture):
+    """
+    Gets one digest lecture ready. Delivers it right away if we can summarize it without
+    the Batch API, and returns True if it should go in today's batch instead.
+    """
+    try:
+        transcript_text = await run_once(('transcript', video_id), lambda: fetch_transcript(video_id))
+    except Exception as e:
+        print(f"Daily digest: no transcript for video {video_id}: {type(e).__name__}: {e}")
+        if is_permanent_transcript_error(e):
+            await skip_digest(video_id, lecture)
+        return False
+    # Batches can take up to a day, so don't hold on to the raw text meanwhile.
+    lecture['transcript'] = CompressedStr(transcript_text)
+
+    # Already summarized for someone else today? Then there's nothing to wait for.
+    summary = cache_get(SUMMARY_CACHE, video_id)
+    if summary is not None:
+        await deliver_digest(video_id, lecture, summary)
+        return False
+
+    transcript_tokens = estimate_tokens(transcript_text)
+    if transcript_tokens > MAX_TRANSCRIPT_TOKENS:
+        print(f"Daily digest: skipping video {video_id}, transcript is too long (~{transcript_tokens} tokens).")
+        await skip_digest(video_id, lecture)
+        return False
+    if transcript_tokens > SINGLE_PASS_MAX_TOKENS:
+        # Too big for one batch request, so this one goes through the regular map-reduce path.
+        try:
+            key = ('summary', video_id)
+            summary = await run_once(key, lambda: summarize_transcript(video_id, lecture['title'], transcript_text, partial(report_progress, key)))
+        except Exception as e:
+            print(f"Daily digest: couldn't summarize video {video_id}: {type(e).__name__}: {e}")
+            return False
+        await deliver_digest(video_id, lecture, summary)
+        return False
+    return True
+
+@tasks.loop(time=DIGEST_TIME)
+async def send_daily_digests():
+    """Once a day, sends every uncached digest lecture off to OpenAI in a single batch job."""
+    # An exception escaping a tasks.loop stops it for good, so nothing in here is allowed to.
+    try:
+        lectures = await collect_digest_lectures()
+    except Exception as e:
+        print(f"Daily digest: couldn't work out who needs what, skipping today: {type(e).__name__}: {e}")
+        return
+
+    batch_lectures = {}
+    for video_id, lecture in lectures.items():
+        try:
+            if await prepare_digest_lecture(video_id, lecture):
+                batch_lectures[video_id] = lecture
+        except Exception as e:
+            print(f"Daily digest: something went wrong with video {video_id}: {type(e).__name__}: {e}")
+
+    if not batch_lectures:
+        return
+
+    # orjson is much faster than json on these, and every line carries a whole transcript.
+    batch_input = b"\n".join(
+        orjson.dumps({
+            'custom_id': video_id,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': {
+                'model': SUMMARY_MODEL,
+                'messages': build_summary_messages(lecture['title'], str(lecture['transcript'])),
+            },
+        })
+        for video_id, lecture in batch_lectures.items()
+    )
+    aclient = await get_openai_client()
+    import openai  # Already loaded by get_openai_client, so this is free.
+    try:
+        batch_file = await aclient.files.create(file=('digest.jsonl', batch_input), purpose='batch')
+        batch = await aclient.batches.create(input_file_id=batch_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+    except openai.OpenAIError as e:
+        print(f"Daily digest: couldn't submit the batch: {e}")
+        return
+    try:
+        await asyncio.to_thread(db_save_digest_batch, batch.id, batch_lectures)
+    except Exception as e:
+        # Without the rows we'd never pick up the results, so don't pay for them.
+        # These lectures aren't marked as delivered, so tomorrow's digest tries them again.
+        print(f"Daily digest: couldn't record batch {batch.id}, cancelling it: {type(e).__name__}: {e}")
+        try:
+            await aclient.batches.cancel(batch.id)
+        except openai.OpenAIError as e:
+            print(f"Daily digest: couldn't cancel batch {batch.id}: {e}")
+        return
+    print(f"Daily digest: submitted batch {batch.id} with {len(batch_lectures)} lecture(s).")
+
+async def finish_digest_batch(aclient, batch_id):
+    """Checks on one submitted digest batch and delivers its summaries if it's done."""
+    import openai
+    try:
+        batch = await aclient.batches.retrieve(batch_id)
+    except openai.OpenAIError as e:
+        print(f"Daily digest: couldn't check batch {batch_id}, will try again later: {e}")
+        return
+    if batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        return
+
+    if batch.status != 'completed' or not batch.output_file_id:
+        print(f"Daily digest: batch {batch_id} ended as '{batch.status}', nothing to deliver.")
+        await asyncio.to_thread(db_delete_digest_batch, batch_id)
+        return
+
+    try:
+        output = await aclient.files.content(batch.output_file_id)
+    except openai.OpenAIError as e:
+        print(f"Daily digest: couldn't download results for batch {batch_id}, will try again later: {e}")
+        return
+
+    batch_lectures = await asyncio.to_thread(db_load_digest_batch, batch_id)
+    for line in output.content.splitlines():
+        if not line.strip():
+            continue
+        # One bad line shouldn't cost everyone else in the batch their summary.
+        try:
+            result = orjson.loads(line)
+            video_id = result['custom_id']
+            lecture = batch_lectures.get(video_id)
+            if lecture is None:
+                print(f"Daily digest: batch {batch_id} has a result for video {video_id} we didn't ask for.")
+                continue
+            response = result.get('response')
+            if result.get('error') or not response or response['status_code'] != 200:
+                print(f"Daily digest: summary for video {video_id} failed: {result.get('error') or response}")
+                continue
+            summary = response['body']['choices'][0]['message']['content']
+            cache_set(SUMMARY_CACHE, video_id, summary)
+            await deliver_digest(video_id, lecture, summary)
+        except Exception as e:
+            print(f"Daily digest: couldn't handle a result line from batch {batch_id}: {type(e).__name__}: {e}")
+    await asyncio.to_thread(db_delete_digest_batch, batch_id)
+
+@tasks.loop(minutes=DIGEST_POLL_MINUTES)
+async def check_digest_batches():
+    """Checks on submitted digest batches and delivers the summaries once one finishes."""
+    # Same as send_daily_digests: an exception escaping here would stop the loop for good.
+    try:
+        batch_ids = await asyncio.to_thread(db_pending_digest_batches)
+    except Exception as e:
+        print(f"Daily digest: couldn't read the pending batches: {type(e).__name__}: {e}")
+        return
+    if not batch_ids:
+        return
+
+    aclient = await get_openai_client()
+    for batch_id in batch_ids:
+        try:
+            await finish_digest_batch(aclient, batch_id)
+        except Exception as e:
+            print(f"Daily digest: something went wrong with batch {batch_id}, will try again later: {type(e).__name__}: {e}")
+
 # --- BOT EVENTS ---
 
 @bot.event
 async def on_ready():
     """Fires when the bot successfully connects to Discord."""
+    # on_ready can fire again after a reconnect, so only set things up once.
+    if not send_daily_digests.is_running():
+        send_daily_digests.start()
+    if not check_digest_batches.is_running():
+        check_digest_batches.start()
     print(f'Alright, {bot.user.name} is online and ready to go!')
 
+@bot.event
+async def on_command_error(ctx, error):
+    """Gives people a friendly heads-up for DM-only commands and cooldowns, and leaves everything else to discord.py."""
+    if isinstance(error, commands.PrivateMessageOnly):
+        await ctx.send("Hey, this command only works in our DMs!")
+    elif isinstance(error, commands.CommandOnCooldown):
+        await ctx.send(f"Easy there! You can use `!{ctx.command.name}` again in {math.ceil(error.retry_after)} seconds. ⏳")
+    elif isinstance(error, commands.MaxConcurrencyReached):
+        await ctx.send(f"I'm still working on your last `!{ctx.command.name}`. Hang tight!")
+    else:
+        await commands.Bot.on_command_error(bot, ctx, error)
+
 # --- BOT COMMANDS ---
 
 @bot.command(name='addsubject', help='Adds a new subject for you to track.')
+@commands.dm_only()
 async def add_subject(ctx, subject_name: str):
     """Creates a new subject profile for the user in their DMs."""
-    # This bot is designed for DMs. Let's make sure we're in one.
-    if not isinstance(ctx.channel, discord.DMChannel):
-        await ctx.send("Hey, this command only works in our DMs. Keeps things private!")
-        return
-
     user_id = ctx.author.id
     subject_name = subject_name.lower()
 
-    # Make a spot for the user if they're new here.
-    if user_id not in user_data:
-        user_data[user_id] = {}
-
     # Check if they've already added this subject.
-    if subject_name in user_data[user_id]:
+    if await get_subject(user_id, subject_name) is not None:
         await ctx.send(f"Looks like you're already tracking '{subject_name}'.")
     else:
-        user_data[user_id][subject_name] = {'playlist_id': None, 'cached_lecture': None}
+        subject = Subject()
+        remember_subject(user_id, subject_name, subject)
+        save_subject(user_id, subject_name, subject)
         await ctx.send(f"Cool, I've added '{subject_name}' to your list. Now use `!setplaylist {subject_name} [url]` to give me the YouTube playlist.")
 
 @bot.command(name='setplaylist', help='Links a YouTube playlist to one of your subjects.')
+@commands.dm_only()
 async def set_playlist(ctx, subject_name: str, playlist_url: str):
     """Links a playlist URL to a subject the user is tracking."""
-    if not isinstance(ctx.channel, discord.DMChannel):
-        await ctx.send("Hey, this command only works in our DMs!")
-        return
-
     user_id = ctx.author.id
     subject_name = subject_name.lower()
 
     # Make sure the subject actually exists first.
-    if user_id not in user_data or subject_name not in user_data[user_id]:
+    subject = await get_subject(user_id, subject_name)
+    if subject is None:
         await ctx.send(f"Hmm, I can't find '{subject_name}' in your list. Try adding it first with `!addsubject {subject_name}`.")
         return
 
     playlist_id = extract_playlist_id(playlist_url)
     if playlist_id:
-        user_data[user_id][subject_name]['playlist_id'] = playlist_id
+        subject.playlist_id = playlist_id
+        save_subject(user_id, subject_name, subject)
         await ctx.send(f"Got it. Playlist for '{subject_name}' is locked in. You're all set to use `!latestlec`.")
     else:
         await ctx.send("That doesn't look like a valid YouTube playlist URL. Make sure it has `list=` in it and try again.")
 
-@bot.command(name='latestlec', help='Summarizes the latest lecture for one of your subjects.')
-async def latest_lecture_summary(ctx, subject_name: str):
-    """The main event: fetches, transcribes, and summarizes the latest lecture video."""
-    if not isinstance(ctx.channel, discord.DMChannel):
-        await ctx.send("Hey, this command only works in our DMs!")
+@bot.command(name='dailydigest', help='Turns your daily lecture digest on or off.')
+@commands.dm_only()
+async def daily_digest(ctx, setting: str):
+    """Opts the user in or out of getting their latest lectures summarized once a day."""
+    setting = setting.lower()
+    if setting not in ('on', 'off'):
+        await ctx.send("Use `!dailydigest on` or `!dailydigest off`.")
         return
 
+    await asyncio.to_thread(db_set_digest, ctx.author.id, setting == 'on')
+    if setting == 'on':
+        await ctx.send("You're signed up! Every day I'll DM you summaries of the latest lectures for all your subjects. 📬")
+    else:
+        await ctx.send("No more daily digests. You can still use `!latestlec` any time.")
+
+@bot.command(name='latestlec', help='Summarizes the latest lecture for one of your subjects.', cooldown_after_parsing=True)
+# Every run costs YouTube quota and an OpenAI call, so one per user per minute,
+# and only one at a time. The DM check runs before the cooldown, and any run
+# that bails out before summarizing gives the user their cooldown back.
+@commands.dm_only()
+@commands.cooldown(rate=1, per=60, type=commands.BucketType.user)
+@commands.max_concurrency(1, per=commands.BucketType.user, wait=False)
+async def latest_lecture_summary(ctx, subject_name: str):
+    """The main event: fetches, transcribes, and summarizes the latest lecture video."""
     user_id = ctx.author.id
     subject_name = subject_name.lower()
 
     # First, let's do some checks to make sure everything is set up.
-    user_profile = user_data.get(user_id)
-    if not user_profile or subject_name not in user_profile or user_profile[subject_name]['playlist_id'] is None:
+    subject = await get_subject(user_id, subject_name)
+    if subject is None or subject.playlist_id is None:
         await ctx.send(f"Looks like '{subject_name}' isn't fully set up. Make sure you've added the subject and set its playlist first.")
+        ctx.command.reset_cooldown(ctx)
         return
         
-    playlist_id = user_profile[subject_name]['playlist_id']
+    playlist_id = subject.playlist_id
     
     await ctx.send("On it! Checking the playlist for the latest lecture... 🕵️")
 
+    if youtube_quota_left() <= YOUTUBE_QUOTA_RESERVE:
+        await ctx.send("I've used up almost all of today's YouTube API quota. Try again tomorrow, sorry! 😅")
+        ctx.command.reset_cooldown(ctx)
+        return
+
+    # The "Writing..." embed, once we've posted it. If anything goes wrong after
+    # that we reuse it for the error, so it isn't left there writing forever.
+    summary_message = None
     try:
         # STEP 1: Find the latest video using the YouTube API.
-        youtube = googleapiclient.discovery.build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
-        request = youtube.playlistItems().list(part="snippet", playlistId=playlist_id, maxResults=1)
-        response = request.execute()
+        latest_video = await get_latest_video(playlist_id)
         
-        if not response['items']:
+        if latest_video is None:
             await ctx.send("I looked, but that playlist seems to be empty.")
+            ctx.command.reset_cooldown(ctx)
             return
             
-        latest_video = response['items'][0]['snippet']
         video_id = latest_video['resourceId']['videoId']
         video_title = latest_video['title']
         video_url = f"https://www.youtube.com/watch?v={video_id}"
 
         await ctx.send(f"Found it: **{video_title}**. Grabbing the transcript now.")
         
-        # STEP 2: Get the video's transcript.
+        # STEP 2: Get the video's transcript (unless someone already fetched it).
+        # If someone else is fetching this exact video right now, we just wait for theirs.
         try:
-            ytt_api = YouTubeTranscriptApi()
-            transcript_data = ytt_api.fetch(video_id)
-            
-            if hasattr(transcript_data, 'transcript'):
-                transcript_list = transcript_data.transcript
-            elif hasattr(transcript_data, 'captions'):
-                transcript_list = transcript_data.captions
-            else:
-                transcript_list = list(transcript_data)
-            
-            transcript_text = " ".join([item['text'] if isinstance(item, dict) else item.text for item in transcript_list])
-            
+            transcript_text = await run_once(('transcript', video_id), lambda: fetch_transcript(video_id))
         except Exception as e:
             print(f"Transcript error for video {video_id}: {type(e).__name__}: {e}")
             print(f"Full error details: {e}")
             await ctx.send(f"Bummer, I couldn't get a transcript for this video. Error: {type(e).__name__}: {str(e)}\n\nHere's the link anyway: {video_url}")
+            ctx.command.reset_cooldown(ctx)
             return
         
-        await ctx.send("Transcript acquired. Sending it to the AI brain for summarization. This can take a moment...")
+        # STEP 3: Summarize the text with OpenAI (again, only if we haven't already).
+        # The summary is streamed, and we keep editing the embed as it comes in
+        # so the user isn't staring at nothing for the whole GPT-4o call.
+        summary = cache_get(SUMMARY_CACHE, video_id)
+        if summary is None:
+            transcript_tokens = estimate_tokens(transcript_text)
+            if transcript_tokens > MAX_TRANSCRIPT_TOKENS:
+                await ctx.send(f"Whoa, this lecture is way too long for me to summarize (roughly {transcript_tokens:,} tokens). Here's the link instead: {video_url}")
+                ctx.command.reset_cooldown(ctx)
+                return
+            if transcript_tokens > SINGLE_PASS_MAX_TOKENS:
+                await ctx.send("Transcript acquired. It's a long one, so I'll summarize it in parts and then stitch those together. This can take a moment...")
+            else:
+                await ctx.send("Transcript acquired. Sending it to the AI brain for summarization. This can take a moment...")
+            summary_message = await ctx.send(embed=build_summary_embed(video_title, video_url, subject_name, "✍️ Writing..."))
 
-        # STEP 3: Summarize the text with OpenAI.
-        prompt = f"Summarize the key points of the following lecture transcript into clear, concise bullet points. Make it easy to digest. Lecture Title: {video_title}\n\nTranscript:\n{transcript_text}"
-        
-        chat_completion = openai.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gpt-4o",
-        )
-        summary = chat_completion.choices[0].message.content
+            async def show_progress(partial_summary):
+                try:
+                    await summary_message.edit(embed=build_summary_embed(video_title, video_url, subject_name, partial_summary + " ▌"))
+                except discord.HTTPException:
+                    pass  # A missed progress update isn't worth failing the summary over.
+
+            # Same deal as the transcript: only one OpenAI call per video at a time.
+            # Whoever gets there first does the work, but everyone's embed streams along.
+            key = ('summary', video_id)
+            summary = await run_once(key, lambda: summarize_transcript(video_id, video_title, transcript_text, partial(report_progress, key)), on_progress=show_progress)
 
         # STEP 4: Cache the result for this user and subject.
-        user_data[user_id][subject_name]['cached_lecture'] = {
-            'transcript': transcript_text,
+        subject.cached_lecture = {
+            'transcript': CompressedStr(transcript_text),
             'summary': summary,
             'title': video_title
         }
+        save_subject(user_id, subject_name, subject)
 
         # STEP 5: Send the final summary back to the user in a nice embed.
-        embed = discord.Embed(
-            title=f"📝 Here's the TL;DW for: {video_title}",
-            description=summary,
-            color=discord.Color.from_rgb(114, 137, 218) # Blurple color
-        )
-        embed.add_field(name="Watch the Full Lecture", value=f"[Click here to watch]({video_url})", inline=False)
-        embed.set_footer(text=f"Now you can run !quizme {subject_name} for a quick quiz on this.")
-        
-        await ctx.send(embed=embed)
+        embed = build_summary_embed(video_title, video_url, subject_name, summary)
+        if summary_message:
+            await summary_message.edit(embed=embed)
+        else:
+            await ctx.send(embed=embed)
 
     except Exception as e:
         # A general catch-all for any other unexpected problems.
-        await ctx.send(f"Whoops, something went wrong on my end. Maybe check the YouTube API key or Playlist ID? Error: {e}")
+        error_text = f"Whoops, something went wrong on my end. Maybe check the YouTube API key or Playlist ID? Error: {e}"
+        try:
+            if summary_message:
+                await summary_message.edit(content=error_text, embed=None)
+            else:
+                await ctx.send(error_text)
+        except discord.HTTPException:
+            pass  # Nothing more we can tell them if Discord itself is the problem.
+        ctx.command.reset_cooldown(ctx)
         print(f"--- An error occurred ---\n{e}\n-------------------------")
 
 # --- Let's get this thing running! ---
+init_db()
 bot.run(DISCORD_TOKEN)
\ No newline at end of file